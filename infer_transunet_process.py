@@ -17,20 +17,68 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from ikomia import core, dataprocess
+import contextlib
 import copy
-import random
 import torch
 import yaml
 from infer_transunet.networks.vit_seg_modeling import VisionTransformer as ViT_seg
 from ml_collections import ConfigDict
 import numpy as np
-from torchvision import transforms
+import torch.nn.functional as F
 import cv2
 import os
-from torchvision.transforms import InterpolationMode
 
 # Your imports below
 
+# TensorRT is optional : when missing, inference stays on the PyTorch path
+try:
+    import tensorrt as trt
+except ImportError:
+    trt = None
+
+# Numba is optional : when missing, the CPU path keeps the torch ops
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# ImageNet statistics of the pretrained backbone
+_NORM_MEAN = np.array([123.675, 116.280, 103.530], dtype=np.float32)
+_NORM_STD = np.array([58.395, 57.120, 57.375], dtype=np.float32)
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _normalize_transpose(img, mean, std):
+        # Fused uint8 -> float32 cast, HWC -> CHW transpose and normalization
+        # in a single parallel pass instead of three full-image round trips
+        n, h, w, c = img.shape
+        out = np.empty((n, c, h, w), dtype=np.float32)
+        for y in prange(h):
+            for b in range(n):
+                for x in range(w):
+                    for k in range(c):
+                        out[b, k, y, x] = (np.float32(img[b, y, x, k]) - mean[k]) / std[k]
+        return out
+else:
+    _normalize_transpose = None
+
+# Prepared models are cached at module level, keyed on configuration content,
+# so a new task instance with the same config reuses the already-built network
+_MODEL_CACHE = {}
+
+
+class _ArgmaxHead(torch.nn.Module):
+    # Folds the label argmax into the exported/compiled graph so the backend
+    # can fuse it with the decoder head, and only the small int32 label map
+    # leaves the graph instead of the full class-logit volume
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return torch.argmax(self.model(x), dim=1).int()
+
 # --------------------
 # - Class to handle the process parameters
 # - Inherits PyCore.CProtocolTaskParam from Ikomia API
@@ -74,9 +122,17 @@ class Transunet(dataprocess.C2dImageTask):
         self.addOutput(dataprocess.CImageIO(core.IODataType.IMAGE))
         self.model = None
         self.cfg = None
+        self.trt_engine = None
+        self.trt_context = None
+        self._graph = None
+        self._static_in = None
+        self._static_out = None
+        self._norm_mean = None
+        self._norm_std = None
         self.colors = None
         self.update = False
         self.classes = None
+        self.legend = None
 
         # Create parameters class
         if param is None:
@@ -94,8 +150,6 @@ class Transunet(dataprocess.C2dImageTask):
         # Call beginTaskRun for initialization
         self.beginTaskRun()
 
-        # we use seed to keep the same color for our masks + boxes + labels (same random each time)
-        random.seed(10)
         # Get input :
         input = self.getInput(0)
         srcImage = input.getImage()
@@ -110,49 +164,93 @@ class Transunet(dataprocess.C2dImageTask):
         # Config file and model file needed are in the output folder generated by the train plugin
         if (self.cfg is None or param.update) and param.configFile != "":
             with open(param.configFile, 'r') as file:
-                str = yaml.load(file, Loader=yaml.Loader)
+                # C-accelerated loader when libyaml is available
+                loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+                str = yaml.load(file, Loader=loader)
                 self.cfg = ConfigDict(str)
                 self.classes = self.cfg.class_names
 
         if (self.model is None or param.update) and self.cfg is not None:
-            print("Building model...")
-            self.model = ViT_seg(self.cfg, img_size=self.cfg.img_size, num_classes=self.cfg.n_classes)
-            print("Model built")
-            if torch.cuda.is_available():
-                self.model.cuda()
-
-            if os.path.isfile(param.modelFile):
-                print("Loading weights...")
-                self.model.load_state_dict(torch.load(param.modelFile))
-                print("Weights loaded")
-            self.model.eval()
+            # Key on the config content and weight file, not the task instance.
+            # The checkpoint mtime invalidates the entry when the model file is
+            # retrained in place, so even a forced update can reuse a cache hit :
+            # the widget re-sends update=True for identical parameters
+            model_mtime = os.path.getmtime(param.modelFile) if os.path.isfile(param.modelFile) else 0
+            key = (repr(self.cfg.to_dict()), param.modelFile, model_mtime)
+
+            if key in _MODEL_CACHE:
+                (self.model, self.trt_engine, self.trt_context,
+                 self._graph, self._static_in, self._static_out) = _MODEL_CACHE[key]
+            else:
+                self._build_model(param)
+                _MODEL_CACHE[key] = (self.model, self.trt_engine, self.trt_context,
+                                     self._graph, self._static_in, self._static_out)
 
         if self.model is not None and srcImage is not None:
-            h, w, c = np.shape(srcImage)
+            # A stack of images can be passed as (n, h, w, c) : all frames then
+            # go through the ViT in a single batched forward
+            batched_input = srcImage.ndim == 4
+            if not batched_input:
+                srcImage = srcImage[np.newaxis, ...]
+            n_img, h, w, c = srcImage.shape
+
+            with torch.inference_mode():
+                # For inputs smaller than the network size, a bicubic cv2.resize
+                # on CPU beats the device round trip : at these sizes kernel
+                # launch overhead dominates the actual resampling work
+                resized = False
+                if h * w < self.cfg.img_size * self.cfg.img_size:
+                    srcImage = np.stack([cv2.resize(img, (self.cfg.img_size, self.cfg.img_size),
+                                                    interpolation=cv2.INTER_CUBIC) for img in srcImage])
+                    resized = True
+
+                normalize = self.cfg.pretrained_path is not None
+                if (not torch.cuda.is_available() and normalize
+                        and _normalize_transpose is not None and srcImage.dtype == np.uint8):
+                    # CPU fallback : one fused Numba pass does the cast, transpose
+                    # and normalization. Normalization is affine per channel so
+                    # applying it before the bicubic resize gives the same result
+                    srcImage = torch.from_numpy(_normalize_transpose(np.ascontiguousarray(srcImage),
+                                                                     _NORM_MEAN, _NORM_STD))
+                    normalize = False
+                else:
+                    # from_numpy is zero-copy and the pinned staging buffer makes
+                    # the host-to-device transfer asynchronous
+                    srcImage = torch.from_numpy(np.ascontiguousarray(srcImage))
+                    if torch.cuda.is_available():
+                        srcImage = srcImage.pin_memory().cuda(non_blocking=True)
+                    srcImage = srcImage.permute(0, 3, 1, 2).float()
+
+                if not resized:
+                    # Resize directly on the device tensor, no torchvision wrapper overhead
+                    srcImage = F.interpolate(srcImage, size=(self.cfg.img_size, self.cfg.img_size),
+                                             mode='bicubic', align_corners=False)
+
+                if normalize:
+                    # Normalize with a single broadcasted kernel instead of a per-channel Python loop
+                    if self._norm_mean is None or self._norm_mean.device != srcImage.device:
+                        self._norm_mean = torch.from_numpy(_NORM_MEAN).to(srcImage.device).view(1, 3, 1, 1)
+                        self._norm_std = torch.from_numpy(_NORM_STD).to(srcImage.device).view(1, 3, 1, 1)
+                    srcImage = srcImage.sub_(self._norm_mean).div_(self._norm_std)
 
-            downsample_img = transforms.Resize(size=(self.cfg.img_size, self.cfg.img_size),interpolation=InterpolationMode.BICUBIC)
-            upsample_pred = transforms.Resize(size=(h,w), interpolation=InterpolationMode.NEAREST)
-
-            with torch.no_grad():
-                srcImage = torch.tensor([srcImage]).permute(0,3,1,2).float()
                 if torch.cuda.is_available():
-                    srcImage=srcImage.cuda()
-                srcImage = downsample_img(srcImage)
-
-                if self.cfg.pretrained_path is not None:
-                    mean = np.array([123.675, 116.280, 103.530], dtype=np.float)
-                    std = np.array([58.395, 57.120, 57.375], dtype=np.float)
-                    srcImage = Normalize(mean=mean,std=std)(srcImage)
+                    srcImage = srcImage.to(memory_format=torch.channels_last)
 
-                pred = self.model(srcImage)
+                # The argmax runs inside the model graph : _forward already
+                # returns the (n, img_size, img_size) label maps
+                pred = self._forward(srcImage)
 
-                pred = torch.argmax(torch.softmax(pred, dim=1), dim=1, keepdim=True)
-                pred = upsample_pred(pred)
-                pred= pred.squeeze()
-                pred = pred.cpu().numpy()
+                # Narrow the labels to the smallest dtype holding n_classes
+                # before the device-to-host copy, then upsample on CPU : much
+                # less data over PCIe than the full-resolution int64 maps.
+                # The upsample stays out of the graph because the output size
+                # follows the source image and would make the graph dynamic
+                label_dtype = torch.uint8 if self.cfg.n_classes <= 255 else torch.int16
+                pred = pred.to(label_dtype).cpu().numpy()
+                pred = np.stack([cv2.resize(p, (w, h), interpolation=cv2.INTER_NEAREST) for p in pred])
 
             # Convert logits to labelled image
-            dstImage = pred
+            dstImage = pred if batched_input else pred[0]
             # Set image of input/output (numpy array):
             # dstImage +1 because value 0 is for background but no background here
             mask_output.setImage(dstImage)
@@ -160,15 +258,21 @@ class Transunet(dataprocess.C2dImageTask):
             # Create random color map
             if self.colors is None or param.update:
                 n = len(self.classes)
-                self.colors = [[0, 0, 0]]
-                for i in range(n - 1):
-                    self.colors.append([random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), 255])
+                # Draw all colors in one vectorized call, seeded to keep the same
+                # colors for our masks + labels each time
+                rng = np.random.default_rng(10)
+                rand_colors = np.hstack((rng.integers(0, 256, size=(n - 1, 3)),
+                                         np.full((n - 1, 1), 255)))
+                self.colors = [[0, 0, 0]] + rand_colors.tolist()
 
                 # Apply color map on labelled image
                 self.setOutputColorMap(1, 0, self.colors)
             self.forwardInputImage(0, 1)
 
-            graph_output.setImage(self.draw_legend())
+            # Legend only depends on classes and colors : draw it once and reuse
+            if self.legend is None or param.update:
+                self.legend = self.draw_legend()
+            graph_output.setImage(self.legend)
             param.update = False
         # Step progress bar:
         self.emitStepProgress()
@@ -176,6 +280,237 @@ class Transunet(dataprocess.C2dImageTask):
         # Call endTaskRun to finalize process
         self.endTaskRun()
 
+    def _trt_engine_path(self):
+        # A serialized plan is only valid for a given input size, GPU architecture,
+        # TensorRT version and checkpoint, so the cached file is keyed on all
+        # four : a retrained model must not silently reuse a stale engine
+        param = self.getParam()
+        major, minor = torch.cuda.get_device_capability()
+        return "{}.img{}_sm{}{}_trt{}_{}.plan".format(os.path.splitext(param.modelFile)[0],
+                                                      self.cfg.img_size, major, minor, trt.__version__,
+                                                      int(os.path.getmtime(param.modelFile)))
+
+    def _build_trt_engine(self):
+        # Export the model to ONNX then compile it to a TensorRT engine.
+        # The plan is cached beside the model file so the build cost is
+        # only paid once per (input size, GPU, TensorRT version)
+        plan_path = self._trt_engine_path()
+        logger = trt.Logger(trt.Logger.WARNING)
+
+        if not os.path.isfile(plan_path):
+            print("Building TensorRT engine...")
+            onnx_path = os.path.splitext(plan_path)[0] + ".onnx"
+            dummy = torch.zeros(1, 3, self.cfg.img_size, self.cfg.img_size, device="cuda")
+            torch.onnx.export(self.model, dummy, onnx_path, opset_version=17)
+
+            builder = trt.Builder(logger)
+            network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+            parser = trt.OnnxParser(network, logger)
+            with open(onnx_path, 'rb') as f:
+                if not parser.parse(f.read()):
+                    raise RuntimeError("ONNX parsing failed")
+
+            config = builder.create_builder_config()
+            major, _ = torch.cuda.get_device_capability()
+            if major >= 8 and hasattr(trt.BuilderFlag, "BF16"):
+                config.set_flag(trt.BuilderFlag.BF16)
+            else:
+                config.set_flag(trt.BuilderFlag.FP16)
+
+            plan = builder.build_serialized_network(network, config)
+            if plan is None:
+                raise RuntimeError("engine build returned no plan")
+
+            with open(plan_path, 'wb') as f:
+                f.write(plan)
+
+            os.remove(onnx_path)
+            print("TensorRT engine built")
+
+        runtime = trt.Runtime(logger)
+        with open(plan_path, 'rb') as f:
+            self.trt_engine = runtime.deserialize_cuda_engine(f.read())
+
+        self.trt_context = self.trt_engine.create_execution_context()
+
+    def _build_model(self, param):
+        print("Building model...")
+        self.model = ViT_seg(self.cfg, img_size=self.cfg.img_size, num_classes=self.cfg.n_classes)
+        print("Model built")
+        if torch.cuda.is_available():
+            # Route FP32 GEMMs through TF32 tensor cores and let cuDNN
+            # benchmark conv algorithms for the fixed input size
+            # (the precision knob only exists from PyTorch 1.12)
+            if hasattr(torch, 'set_float32_matmul_precision'):
+                torch.set_float32_matmul_precision('high')
+            torch.backends.cudnn.benchmark = True
+            self.model.cuda()
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        if os.path.isfile(param.modelFile):
+            print("Loading weights...")
+            try:
+                # weights_only skips unpickling arbitrary objects and mmap maps
+                # the checkpoint instead of reading it all into RAM up front
+                state_dict = torch.load(param.modelFile, map_location='cpu',
+                                        weights_only=True, mmap=True)
+            except TypeError:
+                # older PyTorch without the mmap/weights_only arguments
+                state_dict = torch.load(param.modelFile, map_location='cpu')
+            self.model.load_state_dict(state_dict)
+            print("Weights loaded")
+        self.model.requires_grad_(False)
+        self.model.eval()
+        self.model = _ArgmaxHead(self.model)
+
+        # Compile the model to a TensorRT engine when possible
+        self.trt_engine = None
+        self.trt_context = None
+        if trt is not None and torch.cuda.is_available() and os.path.isfile(param.modelFile):
+            try:
+                self._build_trt_engine()
+            except Exception as e:
+                print("TensorRT engine build failed ({}), falling back to PyTorch".format(e))
+                self.trt_engine = None
+                self.trt_context = None
+
+        # Without TensorRT, compile the forward with inductor : the static
+        # ViT graph fuses well and compiled artifacts are cached on disk
+        compiled = False
+        if self.trt_context is None:
+            try:
+                compiled = self._compile_model()
+            except Exception as e:
+                print("torch.compile failed ({}), falling back to eager forward".format(e))
+
+        # On PyTorch without torch.compile, TorchScript still fuses the
+        # elementwise tail of the decoder head and removes Python dispatch.
+        # The traced module is persisted beside the model file, keyed on the
+        # network input size (the source resolution never enters the graph :
+        # resizes happen outside), so later sessions skip the tracing cost
+        if self.trt_context is None and not compiled:
+            ts_path = None
+            if os.path.isfile(param.modelFile):
+                # The artifact bakes in the weights, so it is also keyed on the
+                # checkpoint mtime : a retrained model is re-traced instead of
+                # silently reloading the old weights
+                ts_path = "{}.img{}_{}.ts".format(os.path.splitext(param.modelFile)[0], self.cfg.img_size,
+                                                  int(os.path.getmtime(param.modelFile)))
+            try:
+                if ts_path is not None and os.path.isfile(ts_path):
+                    device = "cuda" if torch.cuda.is_available() else "cpu"
+                    self.model = torch.jit.load(ts_path, map_location=device)
+                else:
+                    # The forward cannot be scripted (numpy calls and untyped
+                    # tuple returns), but shapes are static and the control
+                    # flow is config-constant, so tracing is safe here
+                    dummy = torch.zeros(1, 3, self.cfg.img_size, self.cfg.img_size)
+                    if torch.cuda.is_available():
+                        dummy = dummy.cuda().to(memory_format=torch.channels_last)
+                    with torch.no_grad():
+                        self.model = torch.jit.trace(self.model, dummy)
+                    if ts_path is not None:
+                        torch.jit.save(self.model, ts_path)
+            except Exception as e:
+                print("TorchScript tracing failed ({}), keeping eager forward".format(e))
+
+        # Without TensorRT nor inductor (which wraps the graph in CUDA graphs
+        # itself in max-autotune mode), capture the forward as a CUDA graph :
+        # input shape is always (1, 3, img_size, img_size) so replaying the
+        # graph removes the per-layer kernel-launch overhead
+        self._graph = None
+        self._static_in = None
+        self._static_out = None
+        if self.trt_context is None and not compiled and torch.cuda.is_available():
+            try:
+                self._capture_cuda_graph()
+            except Exception as e:
+                print("CUDA graph capture failed ({}), falling back to eager forward".format(e))
+                self._graph = None
+                self._static_in = None
+                self._static_out = None
+
+    def _compile_model(self):
+        # torch.compile needs PyTorch >= 2.1 for stable inductor support.
+        # Compiled kernels are cached beside the plugin so later instances
+        # of the task do not repay the autotuning cost
+        version = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+        if version < (2, 1):
+            return False
+
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), ".inductor_cache"))
+        compiled_model = torch.compile(self.model, mode='max-autotune', fullgraph=True, dynamic=False)
+
+        # torch.compile is lazy : run a dummy forward now so a broken triton
+        # install or a graph break fails inside the caller's try and the
+        # TorchScript/CUDA graph fallbacks engage, instead of crashing run()
+        dummy = torch.zeros(1, 3, self.cfg.img_size, self.cfg.img_size)
+        if torch.cuda.is_available():
+            dummy = dummy.cuda().to(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            with self._autocast():
+                compiled_model(dummy)
+
+        self.model = compiled_model
+        return True
+
+    def _forward(self, srcImage):
+        # TensorRT engine and CUDA graph are built for batch 1 : larger
+        # batches go through the (possibly compiled) PyTorch forward
+        if self.trt_context is not None and srcImage.shape[0] == 1:
+            return self._trt_infer(srcImage)
+
+        if self._graph is not None and srcImage.shape[0] == 1:
+            self._static_in.copy_(srcImage)
+            self._graph.replay()
+            return self._static_out
+
+        with self._autocast():
+            return self.model(srcImage)
+
+    def _use_bf16(self):
+        # BF16 autocast on Ampere and newer : same exponent range as FP32
+        # so the segmentation argmax is unaffected
+        return (torch.cuda.is_available() and hasattr(torch.cuda, 'is_bf16_supported')
+                and torch.cuda.is_bf16_supported())
+
+    def _autocast(self):
+        # torch.autocast appeared in PyTorch 1.10 : on the older pin the
+        # forward runs under a no-op context instead
+        if hasattr(torch, 'autocast'):
+            return torch.autocast('cuda', dtype=torch.bfloat16, enabled=self._use_bf16())
+        return contextlib.nullcontext()
+
+    def _capture_cuda_graph(self):
+        # Warm up on a side stream then record the forward into a CUDA graph.
+        # Replaying it later only requires copying the input into the static buffer
+        self._static_in = torch.zeros(1, 3, self.cfg.img_size, self.cfg.img_size,
+                                      device="cuda").to(memory_format=torch.channels_last)
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            with self._autocast():
+                for _ in range(3):
+                    self.model(self._static_in)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            with self._autocast():
+                self._static_out = self.model(self._static_in)
+
+    def _trt_infer(self, srcImage):
+        # Input/output buffers are bound directly from torch CUDA tensors.
+        # The engine embeds the argmax head, so the output is the label map
+        srcImage = srcImage.contiguous()
+        pred = torch.empty((srcImage.shape[0], self.cfg.img_size, self.cfg.img_size),
+                           device="cuda", dtype=torch.int32)
+        bindings = [int(srcImage.data_ptr()), int(pred.data_ptr())]
+        self.trt_context.execute_v2(bindings)
+        return pred
+
     def draw_legend(self):
         img_h = 1000
         img_w = 1000
@@ -203,18 +538,6 @@ class Transunet(dataprocess.C2dImageTask):
         return legend
 
 
-class Normalize(object):
-    def __init__(self, mean, std):
-        self.mean = mean
-        self.std = std
-
-    def __call__(self, image):
-        for t, m, s in zip(image, self.mean, self.std):
-            t.sub_(m).div_(s)
-
-        return image
-
-
 # --------------------
 # - Factory class to build process object
 # - Inherits PyDataProcess.CProcessFactory from Ikomia API